@@ -2,18 +2,28 @@
 import os
 import asyncio
 import base64
+import hashlib
 import io
-import json
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from typing import Any, Dict
 
+import orjson
+
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from starlette.concurrency import run_in_threadpool
 import uvicorn
 
+import cv2
+import numpy as np
+# Deploy with Pillow-SIMD for SSE4/AVX2-accelerated decode/resize/save on x86
+# (same PIL module, no code changes):
+#   pip uninstall pillow && CC="cc -mavx2" pip install pillow-simd
 from PIL import Image, ImageDraw, ImageFont
-import pytesseract
+from tesserocr import OEM, PSM, PyTessBaseAPI
 
 from vapi import Vapi
 
@@ -27,10 +37,30 @@ HTTP_PORT = 3333
 # ─── INIT ───────────────────────────────────────────────────────────
 # app = FastAPI()
 vapi = Vapi(token=VAPI_KEY)  # client
-clients = set()   # for JSON-RPC broadcast
+
+# One bounded outbox per canvas client; broadcast() only enqueues so a
+# slow viewer never stalls the RPC call that triggered the draw.
+clients: Dict[WebSocket, asyncio.Queue] = {}
+CLIENT_QUEUE_SIZE = 128
+
+# Rendered annotation images as (bytes, mime type), keyed by UUID for the
+# /annotated/{id} route. Bounded so long sessions don't accumulate forever.
+_ANNOTATED_CACHE: Dict[str, tuple] = {}
+_ANNOTATED_CACHE_MAX = 32
+
+# Lossy WebP at q=85 is typically 5-10x smaller than PNG for canvas
+# annotations and visually identical for tutoring; PNG stays available
+# via the "format" param for callers that need lossless.
+ANNOTATION_FORMATS = {
+    "WEBP": ("image/webp", {"quality": 85, "method": 4}),
+    "PNG":  ("image/png", {}),
+    "JPEG": ("image/jpeg", {"quality": 85}),
+}
+DEFAULT_ANNOTATION_FORMAT = "WEBP"
 
 app = FastAPI(
     websocket_allowed_origins=["*"],    # ← allow any ws:// client
+    default_response_class=ORJSONResponse,   # skip jsonable_encoder on big payloads
 )
 
 # still add CORS for your HTTP endpoints if you like
@@ -252,6 +282,7 @@ FUNCTIONS = [
             "type": "object",
             "properties": {
                 "image_data": { "type": "string" },
+                "format": { "type": "string", "enum": ["webp","png","jpeg"], "default": "webp" },
                 "annotations": {
                     "type": "array",
                     "items": {
@@ -280,11 +311,107 @@ FUNCTIONS = [
 ]
 
 # ─── JSON-RPC HANDLERS ──────────────────────────────────────────────
+# Snapshots are exported at scale:2; Tesseract doesn't need that much
+# resolution, and its LSTM inference time scales with pixel count.
+OCR_MAX_DIM = 1500
+
+def _extract_json(text: str):
+    """Pull the outermost JSON object out of a model response, or None.
+
+    find/rfind is linear in the response length, unlike the old
+    ``re.search(r'\\{.*\\}', ..., re.DOTALL)`` whose greedy backtracking
+    degrades badly on long outputs.
+    """
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        return orjson.loads(text[start:end + 1])
+    except orjson.JSONDecodeError:
+        return None
+
+def _decode_data_uri(data_uri: str) -> bytes:
+    """Decode a base64 data URI into raw image bytes.
+
+    Slicing a memoryview past the header avoids the fresh multi-MB str
+    that ``.split(",", 1)[1]`` would allocate before base64 even starts.
+    """
+    header_len = data_uri.index(",") + 1
+    encoded = memoryview(data_uri.encode("ascii"))
+    return base64.b64decode(encoded[header_len:])
+
+# OCR runs in a process pool so concurrent snapshots scale across CPU
+# cores instead of serializing on the GIL. Each worker lazily constructs
+# its own long-lived PyTessBaseAPI (the libtesseract C API is neither
+# thread-safe nor shareable across processes), keeping the one-time model
+# load out of the per-request path.
+_ocr_executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+_worker_api = None  # per-worker-process tesseract instance
+
+# Canvas math work is a single uniform block of digits, operators, and
+# variable names — no page layout to segment. LSTM-only with a whitelist
+# shrinks both the segmentation pass and the beam decode search space.
+TESS_CHAR_WHITELIST = "0123456789+-*/=xyzabcdefghijklmnopqrstuvwxyz()[]."
+
+def _ocr_worker(png_bytes: bytes) -> str:
+    global _worker_api
+    if _worker_api is None:
+        _worker_api = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
+        _worker_api.SetVariable("tessedit_char_whitelist", TESS_CHAR_WHITELIST)
+    img = _preprocess_for_ocr(Image.open(io.BytesIO(png_bytes)))
+    _worker_api.SetImage(img)
+    return _worker_api.GetUTF8Text()
+
+def _preprocess_for_ocr(img: Image.Image) -> Image.Image:
+    """Grayscale + CLAHE (+ downscale) so Tesseract does less work on cleaner input."""
+    arr = np.asarray(img.convert("RGB"))
+    gray = cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY)
+    gray = cv2.createCLAHE(clipLimit=2.0).apply(gray)
+    h, w = gray.shape
+    if max(h, w) > OCR_MAX_DIM:
+        scale = OCR_MAX_DIM / max(h, w)
+        gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return Image.fromarray(gray)
+
+# Completed analyses keyed by snapshot digest: idle reconnects resend the
+# same canvas, and a hit skips both OCR and the multi-second Claude call.
+_ANALYSIS_CACHE: Dict[bytes, dict] = {}
+_ANALYSIS_CACHE_MAX = 16
+
+def _cache_analysis(digest: bytes, analysis: dict) -> dict:
+    while len(_ANALYSIS_CACHE) >= _ANALYSIS_CACHE_MAX:
+        _ANALYSIS_CACHE.pop(next(iter(_ANALYSIS_CACHE)))
+    _ANALYSIS_CACHE[digest] = analysis
+    return analysis
+
 async def analyze_canvas_image(params):
-    data = params["image_data"].split(",", 1)[1]
-    img  = Image.open(io.BytesIO(base64.b64decode(data)))
-    text = await run_in_threadpool(pytesseract.image_to_string, img)
+    # base64 decode of a multi-MB snapshot is CPU work; keep it off the
+    # event loop alongside the OCR itself.
+    png_bytes = await run_in_threadpool(_decode_data_uri, params["image_data"])
+    digest = hashlib.sha256(png_bytes).digest()
+    cached = _ANALYSIS_CACHE.get(digest)
+    if cached is not None:
+        return cached
+
+    # Ship the raw PNG (cheap to pickle) to a worker; preprocessing and
+    # tesseract both run off the event loop and off the GIL.
+    loop = asyncio.get_running_loop()
+    text = await loop.run_in_executor(_ocr_executor, _ocr_worker, png_bytes)
     parsed_text = text.strip()
+
+    # A blank canvas is common at session start — don't burn a Claude
+    # call (thousands of tokens, seconds of latency) analyzing nothing.
+    if len(parsed_text) < 3:
+        return _cache_analysis(digest, {
+            "parsed_text": parsed_text,
+            "analysis": {
+                "overall_assessment": "Canvas appears empty",
+                "errors": [],
+                "positive_feedback": [],
+                "next_steps": ["Ask the student to write out the problem they're working on"]
+            }
+        })
     
     # Use Claude to analyze the math work intelligently
     analysis_prompt = f"""
@@ -349,13 +476,10 @@ If no errors are found, still provide constructive feedback and suggestions.
         
         # Extract the analysis from Claude's response
         claude_response = response.choices[0].message.content
-        
+
         # Try to parse JSON from Claude's response
-        import re
-        json_match = re.search(r'\{.*\}', claude_response, re.DOTALL)
-        if json_match:
-            analysis = json.loads(json_match.group())
-        else:
+        analysis = _extract_json(claude_response)
+        if analysis is None:
             # Fallback if JSON parsing fails
             analysis = {
                 "parsed_text": parsed_text,
@@ -376,8 +500,8 @@ If no errors are found, still provide constructive feedback and suggestions.
                 error["location"]["x"] = int(error["location"]["x_percent"] * canvas_width)
                 error["location"]["y"] = int(error["location"]["y_percent"] * canvas_height)
                 error["location"]["radius"] = 30  # Default radius for highlighting
-        
-        return analysis
+
+        return _cache_analysis(digest, analysis)
         
     except Exception as e:
         # Fallback to basic analysis if Claude analysis fails
@@ -399,9 +523,18 @@ async def broadcast(event: str, payload: Dict[str, Any]):
     if not clients:
         print(f"No clients connected to broadcast {event}")
         return
-    
-    msg = json.dumps({"event": event, "payload": payload})
-    await asyncio.gather(*[c.send_text(msg) for c in clients], return_exceptions=True)
+
+    # Encode once to bytes; send_bytes reuses the same buffer for every
+    # client instead of re-encoding the str per send.
+    msg = orjson.dumps({"event": event, "payload": payload}, default=str)
+    # Snapshot the registry once so a connect/disconnect mid-broadcast
+    # can't invalidate the iterator.
+    for q in tuple(clients.values()):
+        try:
+            q.put_nowait(msg)
+        except asyncio.QueueFull:
+            # Slow client: drop the frame rather than blocking everyone.
+            print("Canvas client queue full, dropping broadcast frame")
 
 async def circle_region(params):
     """Draw a circle on the canvas and broadcast to clients"""
@@ -423,48 +556,89 @@ async def draw_rectangle(params):
     await broadcast("draw_rectangle", params)
     return {"success": True, "annotation": "rectangle", "params": params}
 
-async def annotate_image(params):
-    data = params["image_data"].split(",", 1)[1]
-    img  = Image.open(io.BytesIO(base64.b64decode(data)))
-    draw = ImageDraw.Draw(img)
-    
-    # Try to load a better font if available
+@lru_cache(maxsize=32)
+def _font(path: str, size: int):
+    """Load a truetype font once per (path, size); fall back to PIL's default."""
     try:
-        font = ImageFont.truetype("arial.ttf", 14)
+        return ImageFont.truetype(path, size)
     except:
-        font = ImageFont.load_default()
-    
-    for ann in params["annotations"]:
-        color = ann.get("color", "#000")
-        
-        if ann["type"] == "circle":
-            x, y, r = ann["x"], ann["y"], ann["radius"]
-            draw.ellipse((x-r, y-r, x+r, y+r), outline=color, width=3)
-            
-        elif ann["type"] == "text":
-            x, y, txt = ann["x"], ann["y"], ann["text"]
-            fontSize = ann.get("fontSize", 14)
-            try:
-                text_font = ImageFont.truetype("arial.ttf", fontSize)
-            except:
-                text_font = ImageFont.load_default()
-            draw.text((x, y), txt, font=text_font, fill=color)
-            
-        elif ann["type"] == "line":
-            x1, y1, x2, y2 = ann["x"], ann["y"], ann["x2"], ann["y2"]
-            width = ann.get("width", 2)
-            draw.line((x1, y1, x2, y2), fill=color, width=width)
-            
-        elif ann["type"] == "rectangle":
-            x, y, w, h = ann["x"], ann["y"], ann["width"], ann["height"]
-            fill_color = color if ann.get("fill", False) else None
-            outline_color = color if not ann.get("fill", False) else None
-            draw.rectangle((x, y, x+w, y+h), fill=fill_color, outline=outline_color, width=2)
-    
+        return ImageFont.load_default()
+
+def _render_annotations(image_data: str, annotations, fmt: str = DEFAULT_ANNOTATION_FORMAT) -> bytes:
+    """Decode, draw every annotation, and re-encode — all synchronous CPU work."""
+    img  = Image.open(io.BytesIO(_decode_data_uri(image_data)))
+    img.load()   # force the PNG decode now, not lazily inside the first draw call
+    draw = ImageDraw.Draw(img)
+    black = "#000"
+
+    # Partition once by shape so each kind runs as a tight loop over one
+    # locally-bound C-backed draw method, instead of re-dispatching on
+    # ann["type"] for every annotation in the batch.
+    circles, texts, lines, rects = [], [], [], []
+    buckets = {"circle": circles, "text": texts, "line": lines, "rectangle": rects}
+    for ann in annotations:
+        bucket = buckets.get(ann["type"])
+        if bucket is not None:
+            bucket.append(ann)
+
+    ellipse = draw.ellipse
+    for ann in circles:
+        x, y, r = ann["x"], ann["y"], ann["radius"]
+        ellipse((x-r, y-r, x+r, y+r), outline=ann.get("color", black), width=3)
+
+    draw_text_ = draw.text
+    default_font = _font("arial.ttf", 14)
+    for ann in texts:
+        size = ann.get("fontSize", 14)
+        font = default_font if size == 14 else _font("arial.ttf", size)
+        draw_text_((ann["x"], ann["y"]), ann["text"], font=font, fill=ann.get("color", black))
+
+    line = draw.line
+    for ann in lines:
+        line((ann["x"], ann["y"], ann["x2"], ann["y2"]),
+             fill=ann.get("color", black), width=ann.get("width", 2))
+
+    rectangle = draw.rectangle
+    for ann in rects:
+        x, y, w, h = ann["x"], ann["y"], ann["width"], ann["height"]
+        color = ann.get("color", black)
+        if ann.get("fill", False):
+            rectangle((x, y, x+w, y+h), fill=color, width=2)
+        else:
+            rectangle((x, y, x+w, y+h), outline=color, width=2)
+
+    save_opts = ANNOTATION_FORMATS[fmt][1]
+    if fmt == "JPEG" and img.mode != "RGB":
+        img = img.convert("RGB")
     buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    encoded = "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode()
-    return {"annotated_image": encoded}
+    img.save(buf, format=fmt, **save_opts)
+    return buf.getvalue()
+
+async def annotate_image(params):
+    fmt = params.get("format", DEFAULT_ANNOTATION_FORMAT).upper()
+    if fmt not in ANNOTATION_FORMATS:
+        fmt = DEFAULT_ANNOTATION_FORMAT
+    mime = ANNOTATION_FORMATS[fmt][0]
+
+    # The whole decode/draw/encode pipeline blocks, so run it in the
+    # threadpool to keep /rpc and broadcast traffic flowing.
+    image_bytes = await run_in_threadpool(
+        _render_annotations, params["image_data"], params["annotations"], fmt
+    )
+    encoded = f"data:{mime};base64," + base64.b64encode(image_bytes).decode()
+
+    # Also cache the raw image so the front end can stream it from
+    # /annotated/{id} instead of round-tripping the base64 blob.
+    image_id = uuid.uuid4().hex
+    while len(_ANNOTATED_CACHE) >= _ANNOTATED_CACHE_MAX:
+        _ANNOTATED_CACHE.pop(next(iter(_ANNOTATED_CACHE)))
+    _ANNOTATED_CACHE[image_id] = (image_bytes, mime)
+
+    return {
+        "annotated_image": encoded,
+        "annotated_image_id": image_id,
+        "annotated_url": f"/annotated/{image_id}",
+    }
 
 METHODS = {
     "analyze_canvas_image": analyze_canvas_image,
@@ -482,34 +656,58 @@ async def jsonrpc(request: Request):
     id_    = body.get("id")
     handler = METHODS.get(method)
     if not handler:
-        return JSONResponse({"jsonrpc":"2.0","id":id_,"error":{"code":-32601,"message":"Method not found"}})
+        return ORJSONResponse({"jsonrpc":"2.0","id":id_,"error":{"code":-32601,"message":"Method not found"}})
     try:
         result = await handler(body.get("params", {}))
-        return JSONResponse({"jsonrpc":"2.0","id":id_,"result":result})
+        return ORJSONResponse({"jsonrpc":"2.0","id":id_,"result":result})
     except Exception as e:
-        return JSONResponse({"jsonrpc":"2.0","id":id_,"error":{"code":-32000,"message":str(e)}})
+        return ORJSONResponse({"jsonrpc":"2.0","id":id_,"error":{"code":-32000,"message":str(e)}})
+
+# ─── ANNOTATED IMAGE STREAMING ──────────────────────────────────────
+def _iter_image(data: bytes, chunk_size: int = 64 * 1024):
+    """Yield image bytes in chunks so large images stream instead of buffering."""
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+@app.get("/annotated/{image_id}")
+async def annotated_image_route(image_id: str):
+    """Serve a cached annotated image as a binary stream."""
+    entry = _ANNOTATED_CACHE.get(image_id)
+    if entry is None:
+        return ORJSONResponse({"error": "annotated image not found"}, status_code=404)
+    data, mime = entry
+    return StreamingResponse(_iter_image(data), media_type=mime)
 
 # ─── CANVAS CLIENT WEBSOCKET ─────────────────────────────────────────
+async def _client_writer(ws: WebSocket, q: asyncio.Queue):
+    """Drain one client's outbox so broadcast() never awaits a send."""
+    while True:
+        msg = await q.get()
+        await ws.send_bytes(msg)
+
 @app.websocket("/canvas")
 async def canvas_client(ws: WebSocket):
     """WebSocket endpoint for canvas clients to receive annotation broadcasts"""
     await ws.accept()
-    clients.add(ws)
+    q: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+    clients[ws] = q
+    writer = asyncio.create_task(_client_writer(ws, q))
     print(f"Canvas client connected. Total clients: {len(clients)}")
-    
+
     try:
         # Keep connection alive and handle any incoming messages
         async for message in ws.iter_text():
             try:
-                data = json.loads(message)
+                data = orjson.loads(message)
                 # Handle any messages from the canvas client if needed
                 print(f"Received from canvas client: {data}")
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 print(f"Invalid JSON from canvas client: {message}")
     except WebSocketDisconnect:
         print("Canvas client disconnected")
     finally:
-        clients.discard(ws)
+        writer.cancel()
+        clients.pop(ws, None)
         print(f"Canvas client removed. Total clients: {len(clients)}")
 
 # ─── CANVAS SNAPSHOT WS ENDPOINT ───────────────────────────────────
@@ -528,34 +726,54 @@ async def snapshot(ws: WebSocket):
         functions=FUNCTIONS,
         websocket_url=f"ws://localhost:{HTTP_PORT}/rpc"           # websocket_url=f"ws://localhost:{WS_PORT}/"
     )
-    # Stream back every chunk to the front end
+    # Stream back every chunk to the front end. Pydantic chunks already
+    # know how to serialize themselves; anything else goes through orjson.
+    # Either way the frame is sent as bytes with no re-encode.
     async for chunk in resp:
-        await ws.send_text(json.dumps(chunk))
+        dump = getattr(chunk, "model_dump_json", None)
+        if dump is not None:
+            await ws.send_bytes(dump().encode())
+        else:
+            await ws.send_bytes(orjson.dumps(chunk, default=str))
 
 # /rpc handler
 @app.websocket("/rpc")
 async def rpc_ws(ws: WebSocket):
     await ws.accept()
+    # Hot loop at draw-annotation message rates: bind every repeated
+    # lookup to a local once, parse bytes frames directly with orjson
+    # (no UTF-8 str decode), and reply over binary frames.
+    loads       = orjson.loads
+    dumps       = orjson.dumps
+    methods_get = METHODS.get
+    send_bytes  = ws.send_bytes
+    receive     = ws.receive
     try:
-        async for raw in ws.iter_text():
-            req = json.loads(raw)
-            method = req.get("method")
-            id_    = req.get("id")
-            params = req.get("params", {})
-            handler = METHODS.get(method)
+        while True:
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            raw = message.get("bytes")
+            if raw is None:
+                raw = message.get("text")
+                if raw is None:
+                    continue
+            req = loads(raw)
+            id_     = req.get("id")
+            handler = methods_get(req.get("method"))
             if not handler:
-                await ws.send_text(json.dumps({
+                await send_bytes(dumps({
                   "jsonrpc":"2.0","id":id_,
                   "error":{"code":-32601,"message":"Method not found"}
                 }))
                 continue
             try:
-                result = await handler(params)
-                await ws.send_text(json.dumps({
+                result = await handler(req.get("params", {}))
+                await send_bytes(dumps({
                   "jsonrpc":"2.0","id":id_,"result":result
-                }))
+                }, default=str))
             except Exception as e:
-                await ws.send_text(json.dumps({
+                await send_bytes(dumps({
                   "jsonrpc":"2.0","id":id_,
                   "error":{"code":-32000,"message":str(e)}
                 }))
@@ -564,4 +782,12 @@ async def rpc_ws(ws: WebSocket):
 
 # ─── SERVER ENTRYPOINT ──────────────────────────────────────────────
 if __name__ == "__main__":
-    uvicorn.run("server:app", host="0.0.0.0", port=HTTP_PORT, reload=True)
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=HTTP_PORT,
+        loop="uvloop",        # libuv event loop: big win for the ws-heavy workload
+        http="httptools",
+        ws="websockets",
+        reload=True,
+    )